@@ -3,9 +3,17 @@ Communicator module
 
 Module provides the necessary functionality for communicating with the end system.
 """
+import os
+import sys
+import errno
+import time
 import socket
 import struct
-from threading import Thread
+import ctypes
+import select
+import selectors
+from collections import deque
+from threading import Thread, Event, current_thread
 from queue import Queue, Empty
 from abc import abstractmethod
 from enum import Enum
@@ -13,33 +21,176 @@ from enum import Enum
 import numpy as np
 
 
+# Phantom packet layout - 4 big-endian doubles (packet type + 3 data values)
+_PACKET_STRUCT = struct.Struct(">4d")
+
+# Linux UDP generic segmentation offload socket option (not exposed by the socket module)
+_SOL_UDP = 17
+_UDP_SEGMENT = 103
+# Low latency socket options (not exposed by the socket module on all platforms)
+_SO_BUSY_POLL = 46
+_IPTOS_LOWDELAY = 0x10
+
+# Max. number of messages per sendmmsg call (UIO_MAXIOV)
+_SENDMMSG_MAX_MESSAGES = 1024
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """
+    Bind the libc sendmmsg function, which the socket module doesn't expose
+
+    :return:    sendmmsg function or None, if it isn't available on the platform
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    sendmmsg.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int)
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_SENDMMSG = _load_sendmmsg()
+
+
+def _sockaddr_in(address):
+    """
+    Encode an IPv4 address as a C sockaddr_in structure
+
+    :param address:     Tuple of the IP address and port
+
+    :return:            ctypes buffer holding the structure
+    """
+    ip, port = address
+    sockaddr = struct.pack("=H", socket.AF_INET) + struct.pack(">H", port)
+    sockaddr += socket.inet_aton(ip) + bytes(8)
+    return ctypes.create_string_buffer(sockaddr, len(sockaddr))
+
+
+def _sendmmsg(sock, packets, packet_size, address, timeout):
+    """
+    Send equally sized packets over a datagram socket, with as few syscalls as possible
+
+    :param sock:        Datagram socket
+    :param packets:     Bytes-like object of consecutive packets
+    :param packet_size: Size of a single packet [bytes]
+    :param address:     Destination address as a sockaddr_in buffer (see _sockaddr_in)
+    :param timeout:     Max. time to wait for the socket buffer space [s]
+    """
+    count = len(packets) // packet_size
+    # Share the packets memory with the iovecs, if it is writable
+    buffer_type = ctypes.c_char * len(packets)
+    if memoryview(packets).readonly:
+        buffer = buffer_type.from_buffer_copy(packets)
+    else:
+        buffer = buffer_type.from_buffer(packets)
+    buffer_address = ctypes.addressof(buffer)
+    iovecs = (_IOVec * count)()
+    messages = (_MMsgHdr * count)()
+    for i in range(count):
+        iovecs[i].iov_base = buffer_address + i * packet_size
+        iovecs[i].iov_len = packet_size
+        messages[i].msg_hdr.msg_name = ctypes.addressof(address)
+        messages[i].msg_hdr.msg_namelen = len(address)
+        messages[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        messages[i].msg_hdr.msg_iovlen = 1
+
+    sent = 0
+    while sent < count:
+        result = _SENDMMSG(
+            sock.fileno(),
+            ctypes.byref(messages, sent * ctypes.sizeof(_MMsgHdr)),
+            min(count - sent, _SENDMMSG_MAX_MESSAGES),
+            0,
+        )
+        if result >= 0:
+            sent += result
+            continue
+
+        error = ctypes.get_errno()
+        if error != errno.EAGAIN:
+            raise OSError(error, os.strerror(error))
+        # Wait for the socket buffer space
+        if not select.select((), (sock,), (), timeout)[1]:
+            raise BlockingIOError(error, os.strerror(error))
+
+
 class Communicator:
     """
     Abstract Communicator base class
 
     The Communicator defines a UI safe - general interface, for creating
     communication handlers, which connect to end systems, based on defined protocols.
+    All transmission is handled by a single worker thread, which waits on a selector
+    for either received data or a wakeup, signaling queued data for sending.
     """
 
     COMMUNICATION_TIMEOUT = 1.0  # [s]
     COMMUNICATION_RETRIES = 3  # Number of transmission retries
 
-    def __init__(self):
+    WAKEUP_BUFFER_SIZE = 4096  # [bytes]
+    SEND_QUEUE_SIZE = 1024  # Max. number of pending send queue items
+    WORKER_PRIORITY = 1  # Real-time (SCHED_FIFO) priority of the worker thread
+
+    def __init__(self, cpu=None):
+        """
+        :param cpu:     CPU to pin the worker thread to (Linux only), e.g. the one
+                        handling the network interface interrupts
+        """
+        self._cpu = cpu
         self._running = False
         self._queue_receive = Queue()
-        self._queue_send = Queue()
-        self._thread_receiver = Thread(name="receiver", target=self._receiver)
-        self._thread_sender = Thread(name="sender", target=self._sender)
+        # Deque append and popleft are atomic, so no lock is needed with a single consumer
+        self._queue_send = deque()
+        self._selector = None
+        self._wakeup_receive = None
+        self._wakeup_send = None
+        self._thread = None
 
     def connect(self):
         """ Connect to the end system """
         if self._running:
             return
 
+        # Create the wakeup socket pair, used to interrupt the selector on send
+        self._wakeup_receive, self._wakeup_send = socket.socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        # Register everything the worker waits on
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup_receive, selectors.EVENT_READ)
+        handle = self._receive_handle()
+        if handle is not None:
+            self._selector.register(handle, selectors.EVENT_READ)
+
         self._running = True
-        # Start threads
-        self._thread_receiver.start()
-        self._thread_sender.start()
+        # Start a new worker thread, as threads can only be started once
+        self._thread = Thread(name="communicator", target=self._worker)
+        self._thread.start()
 
     def disconnect(self):
         """ Disconnect from the end system """
@@ -48,30 +199,94 @@ class Communicator:
 
         self._running = False
 
-        # Wait until threads finish
-        self._thread_receiver.join(timeout=None)
-        self._thread_sender.join(timeout=None)
+        # Wait until the worker finishes
+        self._wakeup()
+        if self._thread is not current_thread():
+            self._thread.join(timeout=None)
+        self._thread = None
+
+        self._selector.close()
+        self._selector = None
+        self._wakeup_receive.close()
+        self._wakeup_receive = None
+        self._wakeup_send.close()
+        self._wakeup_send = None
+
+    def _wakeup(self):
+        """ Interrupt the worker thread selector """
+        if self._wakeup_send is None:
+            return
+
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            # Wakeup buffer is full - the worker is already signaled
+            pass
 
-    def _receiver(self):
-        while self._running:
-            data = self._receive()
-            if data is None:
-                continue
+    def _configure_worker(self):
+        """ Pin the worker thread to the selected CPU, with a real-time priority """
+        if self._cpu is None or not hasattr(os, "sched_setaffinity"):
+            return
+
+        try:
+            os.sched_setaffinity(0, {self._cpu})
+        except OSError:
+            print("Failed to pin the communication worker to CPU %d!" % self._cpu)
+        try:
+            os.sched_setscheduler(
+                0, os.SCHED_FIFO, os.sched_param(Communicator.WORKER_PRIORITY)
+            )
+        except OSError:
+            # Real-time scheduling requires elevated privileges
+            pass
 
-            self._queue_receive.put_nowait(data)
+    def _worker(self):
+        self._configure_worker()
 
-    def _sender(self):
         while self._running:
+            for key, _ in self._selector.select(
+                timeout=Communicator.COMMUNICATION_TIMEOUT
+            ):
+                if key.fileobj is self._wakeup_receive:
+                    # Consume the wakeup signals
+                    try:
+                        self._wakeup_receive.recv(Communicator.WAKEUP_BUFFER_SIZE)
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                # Drain all pending data in a single wakeup
+                while self._running:
+                    data = self._receive()
+                    if data is None:
+                        break
+                    self._queue_receive.put_nowait(data)
+
+            # Send all queued data
+            self._send_queued()
+
+        # Flush the data, queued right before the disconnect (e.g. the stop packet)
+        self._send_queued()
+
+    def _send_queued(self):
+        """ Send all data from the send queue """
+        while self._queue_send:
+            data = self._queue_send.popleft()
+            if data is None:
+                continue
             try:
-                data = self._queue_send.get(
-                    block=True, timeout=Communicator.COMMUNICATION_TIMEOUT
-                )
-                self._queue_send.task_done()
+                self._send(data)
+            except OSError as e:
+                # A failed send mustn't stop the worker, which also receives
+                print("Failed to send data: %s" % e)
 
-                if data is not None:
-                    self._send(data)
-            except Empty:
-                continue
+    def _receive_handle(self):
+        """
+        Get the object, that signals data availability from the end system
+
+        :return:    Selectable object (e.g. socket) or None, if there is none
+        """
+        return None
 
     @abstractmethod
     def _send(self, data):
@@ -84,7 +299,11 @@ class Communicator:
 
     @abstractmethod
     def _receive(self):
-        """ Receives data from the end systems """
+        """
+        Receives data from the end systems without blocking
+
+        :return:    Received data or None, if no more data is pending
+        """
         pass
 
     def send(self, data):
@@ -92,8 +311,16 @@ class Communicator:
         Queue data for sending to the end system
 
         :param data:    Data to send to the end-system
+
+        :return:        Was the data queued (False if the send queue is full)
         """
-        self._queue_send.put(data)
+        if len(self._queue_send) >= Communicator.SEND_QUEUE_SIZE:
+            print("Send queue is full, data was dropped!")
+            return False
+
+        self._queue_send.append(data)
+        self._wakeup()
+        return True
 
     def receive(self, **kwargs):
         """
@@ -119,6 +346,12 @@ class PhantomCommunicator(Communicator):
 
     RECEIVE_BUFFER_SIZE = 4096  # [bytes]
     PACKET_SIZE = 4  # [bytes]
+    UDP_MAX_SEGMENTS = 64  # Max. number of packets per segmented send (kernel limit)
+    # Pause between the batches of UDP_MAX_SEGMENTS packets, so the bursts don't
+    # overrun the controller receive buffer [s]
+    BATCH_INTERVAL = 0.001
+    SOCKET_BUFFER_SIZE = 1 << 20  # Default kernel socket buffer size [bytes]
+    SOCKET_BUSY_POLL = 50  # Busy polling time on receive (Linux only) [us]
 
     class PacketTypes(Enum):
         START = 0xE0
@@ -128,15 +361,29 @@ class PhantomCommunicator(Communicator):
         TRAJECTORY_END = 0xF2
         TRAJECTORY_SAMPLE = 0xF3
 
-    def __init__(self, ip=None, port_send=None, port_receive=None):
+    # Packet type values as floats, to skip the enum value lookup when encoding
+    _PACKET_TYPE_VALUES = {
+        packet_type: float(packet_type.value) for packet_type in PacketTypes
+    }
+
+    def __init__(self, ip=None, port_send=None, port_receive=None, cpu=None):
         self._ip = ip
         self._port_send = port_send
         self._port_receive = port_receive
 
-        self._sock_send = None
-        self._sock_receive = None
+        # A single socket is used for sending and receiving
+        self._sock = None
+        self._address = None
+        self._sockaddr = None
+        self._segmentation = False
+        self._send_buffer_size = PhantomCommunicator.SOCKET_BUFFER_SIZE
+        self._receive_buffer_size = PhantomCommunicator.SOCKET_BUFFER_SIZE
+        # Confirmation events awaited by send_packet, by packet type value
+        self._confirmations = {}
+        # Reusable receive buffer, to avoid allocating a new one for every packet
+        self._receive_buffer = bytearray(PhantomCommunicator.RECEIVE_BUFFER_SIZE)
 
-        super().__init__()
+        super().__init__(cpu=cpu)
 
         # Connect immediately if all connection details were input
         if ip is not None and port_send is not None and port_receive is not None:
@@ -151,65 +398,237 @@ class PhantomCommunicator(Communicator):
         if port_receive is not None:
             self._port_receive = port_receive
 
-        if self._sock_send is not None or self._sock_receive is not None:
+        if self._sock is not None:
             return
 
-        # Create sender socket and connect to the server
-        self._sock_send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock_send.connect((self._ip, self._port_send))
-        # Create receiver socket and bind address
-        self._sock_receive = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock_receive.bind((self._ip, self._port_receive))
-        self._sock_receive.settimeout(PhantomCommunicator.COMMUNICATION_TIMEOUT)
-
-        # Start the sender and receiver threads
+        # Resolve the controller address once
+        self._address = (socket.gethostbyname(self._ip), self._port_send)
+        self._sockaddr = _sockaddr_in(self._address)
+        # Create the socket and bind the receive address. The socket isn't connected,
+        # as the controller may send its data from a different port.
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((self._ip, self._port_receive))
+        if sys.platform == "win32":
+            # Don't report the ICMP port unreachable messages (e.g. while the
+            # controller isn't listening yet) as resets on the following receives
+            self._sock.ioctl(socket.SIO_UDP_CONNRESET, False)
+        self._configure_socket(self._sock)
+        self._segmentation = self._enable_segmentation()
+        self._sock.setblocking(False)
+
+        # Start the communication worker
         super().connect()
 
     def disconnect(self):
         super().disconnect()
 
-        # Close sockets
-        if self._sock_send is not None:
-            self._sock_send.close()
-            self._sock_send = None
+        # Close the socket
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def set_socket_buffers(self, send=None, receive=None):
+        """
+        Set the kernel socket buffer sizes
+
+        The sizes are applied immediately, if connected, and on every following
+        connect. On Linux the kernel silently caps the sizes at the net.core.wmem_max
+        and net.core.rmem_max sysctl values, which must be raised for larger buffers.
+
+        :param send:        Send buffer size [bytes] or None, to keep the current one
+        :param receive:     Receive buffer size [bytes] or None, to keep the current one
+        """
+        if send is not None:
+            self._send_buffer_size = send
+        if receive is not None:
+            self._receive_buffer_size = receive
+
+        if self._sock is not None:
+            self._configure_socket(self._sock)
+
+    def _configure_socket(self, sock):
+        """
+        Tune the socket for low latency control traffic
+
+        Options, which aren't supported or permitted on the platform, are skipped.
+
+        :param sock:    Socket to configure
+        """
+        options = [
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, self._send_buffer_size),
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, self._receive_buffer_size),
+            (socket.IPPROTO_IP, socket.IP_TOS, _IPTOS_LOWDELAY),
+        ]
+        if sys.platform.startswith("linux"):
+            options.append(
+                (socket.SOL_SOCKET, _SO_BUSY_POLL, PhantomCommunicator.SOCKET_BUSY_POLL)
+            )
+
+        for level, option, value in options:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError:
+                pass
+
+    def _enable_segmentation(self):
+        """
+        Let the kernel split multi-packet sends into separate datagrams (Linux only)
+
+        :return:    Was the segmentation enabled
+        """
+        if not sys.platform.startswith("linux"):
+            return False
+
+        try:
+            self._sock.setsockopt(_SOL_UDP, _UDP_SEGMENT, _PACKET_STRUCT.size)
+        except OSError:
+            return False
+
+        return True
+
+    def _segmentation_failed(self, error):
+        """
+        Disable the segmentation, if the send error shows the route doesn't support it
+        (e.g. IPsec routes or devices without the checksum offload)
 
-        if self._sock_receive is not None:
-            self._sock_receive.close()
-            self._sock_receive = None
+        :param error:   OSError raised by the send
+
+        :return:        Was the segmentation disabled
+        """
+        if not self._segmentation or error.errno not in (errno.EIO, errno.EINVAL):
+            return False
+
+        self._segmentation = False
+        try:
+            self._sock.setsockopt(_SOL_UDP, _UDP_SEGMENT, 0)
+        except OSError:
+            pass
+        print("UDP segmentation isn't supported, packets are sent separately!")
+        return True
+
+    def _receive_handle(self):
+        return self._sock
 
     def _send(self, data):
         """
         Send a data to the controller
 
-        :param data:    1D Numpy array
+        :param data:    1D Numpy array or a bytes-like object of consecutive encoded packets
         """
-        if self._sock_send is None:
+        if self._sock is None:
+            return
+
+        if not isinstance(data, np.ndarray):
+            self._send_packets(memoryview(data))
             return
 
-        # Encode data
-        packet = struct.pack(">%sd" % data.size, *data.flatten("F"))
+        # Encode data - the column-major order only matters for multidimensional arrays
+        if data.size == PhantomCommunicator.PACKET_SIZE:
+            packet = _PACKET_STRUCT.pack(*(data if data.ndim == 1 else data.ravel("F")))
+        else:
+            packet = np.asarray(data, dtype=">f8").tobytes(order="F")
         # Send the data to the controller
-        self._sock_send.sendto(packet, (self._ip, self._port_send))
+        self._write(packet)
+
+    def _write(self, datagram):
+        """
+        Send a datagram to the controller, waiting for the socket buffer space if needed
+
+        :param datagram:    Bytes-like object to send
+        """
+        for retry in range(PhantomCommunicator.COMMUNICATION_RETRIES):
+            try:
+                self._sock.sendto(datagram, self._address)
+                return
+            except BlockingIOError:
+                select.select(
+                    (), (self._sock,), (), PhantomCommunicator.COMMUNICATION_TIMEOUT
+                )
+            except OSError as e:
+                # Resend a single packet without the segmentation, if it isn't supported
+                if len(datagram) > _PACKET_STRUCT.size:
+                    raise
+                if not self._segmentation_failed(e):
+                    raise
+
+        print("Send buffer is full, data was dropped!")
+
+    def _send_packets(self, packets):
+        """
+        Send encoded packets to the controller, each as a separate datagram
+
+        Packets are passed to the kernel in paced batches, either as segmented writes
+        or through sendmmsg, falling back to a single send per packet.
+
+        :param packets:     Memoryview of consecutive encoded packets
+        """
+        step = _PACKET_STRUCT.size * PhantomCommunicator.UDP_MAX_SEGMENTS
+        for offset in range(0, len(packets), step):
+            if offset:
+                time.sleep(PhantomCommunicator.BATCH_INTERVAL)
+            self._send_batch(packets[offset : offset + step])
+
+    def _send_batch(self, packets):
+        """
+        Send up to UDP_MAX_SEGMENTS encoded packets to the controller at once
+
+        :param packets:     Memoryview of consecutive encoded packets
+        """
+        if self._segmentation:
+            try:
+                self._write(packets)
+                return
+            except OSError as e:
+                # Resend the packets without the segmentation, if it isn't supported
+                if not self._segmentation_failed(e):
+                    raise
+
+        step = _PACKET_STRUCT.size
+        if _SENDMMSG is not None and len(packets) > step:
+            try:
+                _sendmmsg(
+                    self._sock,
+                    packets,
+                    step,
+                    self._sockaddr,
+                    PhantomCommunicator.COMMUNICATION_TIMEOUT,
+                )
+            except BlockingIOError:
+                print("Send buffer is full, data was dropped!")
+            return
+
+        for offset in range(0, len(packets), step):
+            self._write(packets[offset : offset + step])
 
     def _receive(self):
         """
         Receive a data from the controller
 
-        :return:    1D Numpy array
+        Invalid packets are skipped and awaited confirmations are passed on to their
+        waiters, until another packet is found or the socket is drained.
+
+        :return:    Packet as a tuple of 4 floats or None, if no packet is pending
         """
-        if self._sock_receive is None:
-            return None
+        while self._sock is not None:
+            # Receive the data from the controller
+            try:
+                size = self._sock.recv_into(self._receive_buffer)
+            except BlockingIOError:
+                return None
+            except ConnectionResetError:
+                # Unreachable controller of a previous send - keep receiving
+                continue
 
-        # Receive the data from the controller
-        try:
-            packet = self._sock_receive.recv(PhantomCommunicator.RECEIVE_BUFFER_SIZE)
-            return struct.unpack(">%sd" % PhantomCommunicator.PACKET_SIZE, packet)
-        except struct.error:
-            print("Invalid data format received!")
-        except socket.timeout:
-            pass
-        except ConnectionResetError:
-            self.disconnect()
+            if size != _PACKET_STRUCT.size:
+                print("Invalid data format received!")
+                continue
+
+            packet = _PACKET_STRUCT.unpack_from(self._receive_buffer)
+            # Route confirmations directly to their waiter
+            confirmation = self._confirmations.pop(packet[0], None)
+            if confirmation is None:
+                return packet
+            confirmation.set()
 
         return None
 
@@ -218,30 +637,51 @@ class PhantomCommunicator(Communicator):
         Sends a single 4 byte packet to the Phantom controller
 
         :param packet_type: Type of the packet (PacketTypes)
-        :param data:        1D Numpy array of size 3
+        :param data:        Sequence of 3 numbers (e.g. 1D Numpy array of size 3)
                             Data to send in the packet, if the data is None zeros will be sent,
                             after the packet type
         :param confirm:     Does the packet expect a confirmation response?
 
         :return             Was the sending/confirmation successful
         """
-        packet = np.zeros(PhantomCommunicator.PACKET_SIZE, dtype=np.double)
-        # Assign packet type
-        packet[0] = packet_type.value
-        # Assign data, if any was provided
-        if data is not None:
-            packet[1:] = data
-        # Send the packet to the controller
-        self.send(packet)
+        packet_value = PhantomCommunicator._PACKET_TYPE_VALUES[packet_type]
+        # Encode the packet type and data, if any was provided
+        if data is None:
+            packet = _PACKET_STRUCT.pack(packet_value, 0.0, 0.0, 0.0)
+        else:
+            packet = _PACKET_STRUCT.pack(packet_value, *data)
+        if not confirm:
+            # Send the packet to the controller
+            return self.send(packet)
+
+        # Register the confirmation before sending, so it can't be missed
+        confirmation = Event()
+        self._confirmations[packet_value] = confirmation
+        if not self.send(packet):
+            # Don't wait for the confirmation of a dropped packet
+            self._confirmations.pop(packet_value, None)
+            return False
         # Wait for confirmation
-        if confirm:
-            confirmation = self.receive(
-                block=True, timeout=PhantomCommunicator.COMMUNICATION_TIMEOUT
-            )
-            if confirmation is None or confirmation[0] != packet_type.value:
-                return False
+        confirmed = confirmation.wait(timeout=PhantomCommunicator.COMMUNICATION_TIMEOUT)
+        self._confirmations.pop(packet_value, None)
+        return confirmed
 
-        return True
+    @staticmethod
+    def _encode_packets(packet_type, data):
+        """
+        Encode multiple packets of the same type in a single pass
+
+        :param packet_type: Type of the packets (PacketTypes)
+        :param data:        2D Numpy array of size Nx3, with the data of each packet
+
+        :return:            Writable byte memoryview of N consecutive encoded packets
+        """
+        packets = np.empty(
+            (data.shape[0], PhantomCommunicator.PACKET_SIZE), dtype=">f8"
+        )
+        packets[:, 0] = PhantomCommunicator._PACKET_TYPE_VALUES[packet_type]
+        packets[:, 1:] = data
+        return memoryview(packets).cast("B")
 
     def send_start(self):
         """
@@ -263,6 +703,20 @@ class PhantomCommunicator(Communicator):
         """
         self.send_packet(PhantomCommunicator.PacketTypes.BALL_POSITION, data=position)
 
+    def send_ball_positions(self, positions):
+        """
+        Send coordinates of all detected balls to the controller, as a single queued batch
+
+        Each ball is still sent in its own packet.
+
+        :param positions:   Ball coordinates as a 2D Numpy array of size Nx3
+        """
+        self.send(
+            self._encode_packets(
+                PhantomCommunicator.PacketTypes.BALL_POSITION, positions
+            )
+        )
+
     def send_trajectory(self, trajectory):
         """
         Send the new trajectory to the controller
@@ -274,14 +728,19 @@ class PhantomCommunicator(Communicator):
         if trajectory.shape[0] < 3:
             return False
 
+        # Encode all samples at once
+        samples = self._encode_packets(
+            PhantomCommunicator.PacketTypes.TRAJECTORY_SAMPLE, trajectory
+        )
+
         for retry in range(PhantomCommunicator.COMMUNICATION_RETRIES):
             # Signal trajectory transmission start
             if not self._send_trajectory_start(len(trajectory)):
                 continue
 
-            # Send all samples
-            for sample in trajectory:
-                self._send_trajectory_sample(sample)
+            # Send all samples, retrying the transmission if they were dropped
+            if not self.send(samples):
+                continue
 
             # Signal trajectory transmission stop
             if self._send_trajectory_end():
@@ -297,10 +756,10 @@ class PhantomCommunicator(Communicator):
 
         :return     Was the sending/confirmation successful
         """
-        packet = np.zeros(PhantomCommunicator.PACKET_SIZE - 1)
-        packet[0] = length
         return self.send_packet(
-            PhantomCommunicator.PacketTypes.TRAJECTORY_START, data=packet, confirm=True
+            PhantomCommunicator.PacketTypes.TRAJECTORY_START,
+            data=(length, 0.0, 0.0),
+            confirm=True,
         )
 
     def _send_trajectory_end(self):
@@ -313,14 +772,6 @@ class PhantomCommunicator(Communicator):
             PhantomCommunicator.PacketTypes.TRAJECTORY_END, confirm=True
         )
 
-    def _send_trajectory_sample(self, sample):
-        """
-        Send the trajectory sample
-
-        :param sample:  Sample as tuple of length 3
-        """
-        self.send_packet(PhantomCommunicator.PacketTypes.TRAJECTORY_SAMPLE, data=sample)
-
 
 if __name__ == "__main__":
     # Phantom communicator test
@@ -0,0 +1,222 @@
+"""
+Grabber module
+
+Module provides screen capture backends, specialized for each platform.
+"""
+import sys
+import time
+from collections import deque
+from threading import Thread, Condition
+from abc import abstractmethod
+
+import numpy as np
+from mss import mss
+
+try:
+    import dxcam
+except ImportError:
+    dxcam = None
+
+
+class ScreenGrabber:
+    """ Abstract screen grabber base class """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    @abstractmethod
+    def monitor(self):
+        """
+        Area of the whole primary monitor
+
+        :return:    Dictionary with top, left, width and height of the monitor
+        """
+        pass
+
+    @abstractmethod
+    def grab(self, area):
+        """
+        Grab the screen area
+
+        :param area:    Dictionary with top, left, width and height of the area
+
+        :return:        BGRA image as 3D Numpy array, which may be drawn on
+        """
+        pass
+
+    def close(self):
+        """ Release the capture resources """
+        pass
+
+
+class MSSGrabber(ScreenGrabber):
+    """ Portable screen grabber, using MSS """
+
+    def __init__(self):
+        self._capture = mss()
+
+    @property
+    def monitor(self):
+        return self._capture.monitors[1]
+
+    def grab(self, area):
+        # Wrap the captured pixels without copying them
+        shot = self._capture.grab(area)
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(
+            shot.height, shot.width, 4
+        )
+
+    def close(self):
+        self._capture.close()
+
+
+class DXCamGrabber(ScreenGrabber):
+    """ Windows screen grabber, using DXGI Desktop Duplication through DXcam """
+
+    FRAME_TIMEOUT = 5.0  # Max. time to wait for the first frame [s]
+    FRAME_POLL_INTERVAL = 0.005  # Time between the first frame grab attempts [s]
+
+    def __init__(self):
+        self._camera = dxcam.create(output_idx=0, output_color="BGRA")
+        # Last grabbed whole screen frame, repeated while the screen doesn't change
+        self._frame = None
+
+    @property
+    def monitor(self):
+        return {
+            "top": 0,
+            "left": 0,
+            "width": self._camera.width,
+            "height": self._camera.height,
+        }
+
+    def grab(self, area):
+        # DXcam returns no frame, while the screen doesn't change. The whole screen is
+        # kept, so any area can be cropped from it, without waiting for a change.
+        frame = self._camera.grab()
+        if frame is None and self._frame is None:
+            deadline = time.monotonic() + DXCamGrabber.FRAME_TIMEOUT
+            while frame is None:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("No screen frame was captured!")
+                time.sleep(DXCamGrabber.FRAME_POLL_INTERVAL)
+                frame = self._camera.grab()
+        if frame is not None:
+            self._frame = frame
+
+        # Copy the area, since the consumers draw on the returned image
+        top, left = area["top"], area["left"]
+        return self._frame[
+            top : top + area["height"], left : left + area["width"]
+        ].copy()
+
+    def close(self):
+        self._camera.release()
+
+
+class ThreadedGrabber(ScreenGrabber):
+    """ Screen grabber, capturing the newest frames in a background thread """
+
+    # Frames grabbed in advance, before the thread waits for the next request
+    FRAMES_AHEAD = 4
+
+    def __init__(self, factory):
+        """
+        :param factory:     Callable, creating the underlying screen grabber
+        """
+        self._factory = factory
+        self._condition = Condition()
+        self._monitor = None
+        self._area = None
+        # Only the newest frame is kept, older ones are dropped
+        self._frames = deque(maxlen=1)
+        self._frames_ahead = 0
+        self._error = None
+        self._closed = False
+
+        self._thread = Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        try:
+            # Capture instances aren't shared between threads
+            with self._factory() as grabber:
+                with self._condition:
+                    self._monitor = dict(grabber.monitor)
+                    self._condition.notify_all()
+
+                while True:
+                    with self._condition:
+                        self._condition.wait_for(
+                            lambda: self._closed
+                            or (
+                                self._area is not None
+                                and self._frames_ahead < ThreadedGrabber.FRAMES_AHEAD
+                            )
+                        )
+                        if self._closed:
+                            return
+                        area = self._area
+                    frame = grabber.grab(area)
+
+                    with self._condition:
+                        self._frames.append((area, frame))
+                        self._frames_ahead += 1
+                        self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def _wait(self, predicate):
+        """
+        Wait for the capture thread, while holding the condition
+
+        :param predicate:   Callable, returning true when the wait is over
+        """
+        self._condition.wait_for(lambda: predicate() or self._error is not None)
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def monitor(self):
+        with self._condition:
+            self._wait(lambda: self._monitor is not None)
+            return self._monitor
+
+    def grab(self, area):
+        with self._condition:
+            # Restart the capture on a new area
+            if area != self._area:
+                self._area = dict(area)
+                self._frames.clear()
+            self._frames_ahead = 0
+            self._condition.notify_all()
+
+            while True:
+                self._wait(lambda: self._frames)
+                frame_area, frame = self._frames.popleft()
+                # Skip the frame, if grabbed before the area changed
+                if frame_area is self._area:
+                    return frame
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+def create_grabber():
+    """
+    Create the fastest screen grabber available on the platform
+
+    :return:    Screen grabber instance
+    """
+    if sys.platform == "win32" and dxcam is not None:
+        return ThreadedGrabber(DXCamGrabber)
+    return ThreadedGrabber(MSSGrabber)
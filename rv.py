@@ -1,11 +1,15 @@
-from enum import Enum
+import os
+import sys
+import zlib
+import ctypes
+from ctypes import wintypes
 
 import numpy as np
 import cv2
-from mss import mss
 
 from communicator import PhantomCommunicator
-from tracker import BallTracker
+from grabber import create_grabber
+from tracker import BallTracker, cuda_enabled
 
 
 WIN_NAME = "RV seminarska"
@@ -20,9 +24,24 @@ class App:
     CAPTURE_SIZE_LIMIT_X = 200
     CAPTURE_SIZE_LIMIT_Y = 100
 
+    # Max. number of trajectory points
+    TRAJECTORY_SIZE_LIMIT = 4096
+
+    # Every N-th tracking frame waits for keys, others only poll (if supported)
+    KEY_WAIT_INTERVAL = 4
+
+    # Unchanged frames are reprocessed at least every N-th frame
+    FRAME_REFRESH_INTERVAL = 30
+
+    # Controller socket buffer size, to absorb bursts without drops [bytes]
+    SOCKET_BUFFER_SIZE = 12 * 1024 * 1024
+
     # Key list
     KEY_QUIT = "q"
     KEY_CAPTURE_AREA = "r"
+    # Key codes, as returned by the OpenCV key functions
+    KEY_QUIT_CODE = ord(KEY_QUIT)
+    KEY_CAPTURE_AREA_CODE = ord(KEY_CAPTURE_AREA)
 
     # Colors
     COLOR_DRAW = (255, 102, 102)
@@ -31,23 +50,42 @@ class App:
     COLOR_MARK = (0, 255, 0)
     COLOR_TEXT = (255, 255, 255)
 
-    class States(Enum):
+    # Tracking instructions as (text, position) pairs
+    TRACKING_INSTRUCTIONS = (
+        ("Press the left button to start drawing the trajectory", (50, 50)),
+        ("Press the right button to clear the trajectory", (50, 75)),
+        ("Press R key to reselect the capture area", (50, 100)),
+        ("Press Q key to quit the program", (50, 125)),
+    )
+
+    # States are plain integers, which hash and compare faster than Enum members
+    class States:
         STATE_QUIT = -2
         STATE_HANDSHAKE = -1
         STATE_CAPTURE_AREA = 0
         STATE_CALIBRATE = 1
         STATE_TRACKING = 2
 
-    class TrajectoryStates(Enum):
+    class TrajectoryStates:
         STATE_DRAWING = 0
         STATE_TRANSMISSION_PASS = 1
         STATE_TRANSMISSION_FAIL = 2
 
-    def __init__(self, name, server_ip, port_send, port_receive):
+    def __init__(
+        self, name, server_ip, port_send, port_receive, cpu=None, opencl=False
+    ):
+        """
+        :param cpu:     CPU to pin the tracking loop to or None, to leave it unpinned.
+                        On Linux the OpenCV worker threads inherit the pinning, so
+                        their parallel processing is lost.
+        :param opencl:  Process the frames with OpenCL (T-API), if CUDA isn't present.
+                        The frame transfers only pay off on fast OpenCL devices.
+        """
         self._name = name
         self._server_ip = server_ip
         self._port_send = port_send
         self._port_receive = port_receive
+        self._cpu = cpu
 
         self._state = App.States.STATE_HANDSHAKE
 
@@ -61,13 +99,36 @@ class App:
         self._calibration_retries = 0
 
         # State - tracking
-        self._trajectory = []
+        self._gray = None
+        # Persistent GPU frame buffers, used if a CUDA device is present
+        self._cuda = cuda_enabled()
+        self._gpu_screen = cv2.cuda_GpuMat() if self._cuda else None
+        self._gpu_gray = cv2.cuda_GpuMat() if self._cuda else None
+        # Without CUDA, convert the frames with OpenCL (T-API) if enabled and available
+        self._opencl = (
+            opencl and not self._cuda and cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+        )
+        # Trajectory points are stored in a preallocated buffer
+        self._trajectory = np.empty((App.TRAJECTORY_SIZE_LIMIT, 2), dtype=np.int32)
+        self._trajectory_length = 0
         self._trajectory_state = App.TrajectoryStates.STATE_DRAWING
         self._drawing = False
+        self._frame_counter = 0
+        # Last processed frame, used to skip the processing of unchanged frames
+        self._last_frame_key = None
+        self._last_rendered = None
+        self._last_positions = None
+        self._skipped_frames = 0
+        # Pixels and opacity of the rendered tracking instructions
+        self._instructions = None
+        self._poll_key = hasattr(cv2, "pollKey")
 
         self.comm = PhantomCommunicator(
             ip=server_ip, port_send=port_send, port_receive=port_receive
         )
+        self.comm.set_socket_buffers(
+            send=App.SOCKET_BUFFER_SIZE, receive=App.SOCKET_BUFFER_SIZE
+        )
         self.tracker = BallTracker()
 
     @staticmethod
@@ -85,6 +146,39 @@ class App:
             image, text, position, cv2.FONT_HERSHEY_SIMPLEX, scale, color,
         )
 
+    @staticmethod
+    def _render_instructions(shape, instructions):
+        """
+        Renders text instructions and returns the pixels they cover
+
+        :param shape:           Shape (height, width) of the image to draw on
+        :param instructions:    Sequence of (text, position) pairs
+
+        :return:                Tuple of row and column indices of the text pixels
+                                and their opacity as a 2D Numpy array of size Nx1
+        """
+        mask = np.zeros(shape, dtype=np.uint8)
+        for text, position in instructions:
+            App._draw_instruction(mask, text, position=position, color=255)
+
+        pixels = np.nonzero(mask)
+        alpha = mask[pixels].reshape(-1, 1) / 255.0
+        return pixels, alpha
+
+    @staticmethod
+    def _blend_instructions(image, pixels, alpha, color=COLOR_TEXT):
+        """
+        Draws pre-rendered text instructions on the screen
+
+        :param image:   Image on which to draw the text
+        :param pixels:  Row and column indices of the text pixels
+        :param alpha:   Opacity of the text pixels as a 2D Numpy array of size Nx1
+        :param color:   Color of the text
+        """
+        channels = image[..., :3]
+        background = channels[pixels]
+        channels[pixels] = background + alpha * (np.asarray(color) - background)
+
     def _mouse_callback_select(self, event, x, y, flags, param):
         """ Handles capture area selection """
         if event == cv2.EVENT_MOUSEMOVE and self._selecting_capture:
@@ -98,22 +192,10 @@ class App:
             return
 
         elif event == cv2.EVENT_LBUTTONUP:
-            # Calculate capture coordinates
-            self._capture_coord["top"] = (
-                int(self._capture_area[0, 1])
-                if self._capture_area[0, 1] < self._capture_area[1, 1]
-                else int(self._capture_area[1, 1])
-            )
-            self._capture_coord["left"] = (
-                int(self._capture_area[0, 0])
-                if self._capture_area[0, 0] < self._capture_area[1, 0]
-                else int(self._capture_area[1, 0])
-            )
-            self._capture_coord["width"] = int(
-                abs(self._capture_area[1, 0] - self._capture_area[0, 0])
-            )
-            self._capture_coord["height"] = int(
-                abs(self._capture_area[1, 1] - self._capture_area[0, 1])
+            # Calculate capture coordinates from the opposite corners of the area
+            (left, top), (right, bottom) = np.sort(self._capture_area, axis=0).tolist()
+            self._capture_coord.update(
+                top=top, left=left, width=right - left, height=bottom - top
             )
             # Stop capturing area
             self._selecting_capture = False
@@ -129,28 +211,30 @@ class App:
             self._state = App.States.STATE_CALIBRATE
             return
 
-    def _mouse_callback(self, event, x, y, flags, param):
+    def _mouse_callback_trajectory(self, event, x, y, flags, param):
         """ Handles trajectory drawing """
-        if self._state == App.States.STATE_CAPTURE_AREA:
-            self._mouse_callback_select(event, x, y, flags, param)
-            return
-
         if event == cv2.EVENT_MOUSEMOVE and self._drawing:
-            self._trajectory.append((x, y, 0))
+            # Keep the last slot free for closing the trajectory
+            if self._trajectory_length < App.TRAJECTORY_SIZE_LIMIT - 1:
+                self._trajectory[self._trajectory_length] = (x, y)
+                self._trajectory_length += 1
             return
 
         elif event == cv2.EVENT_LBUTTONDOWN:
-            self._trajectory.clear()
+            self._trajectory_length = 0
             self._trajectory_state = App.TrajectoryStates.STATE_DRAWING
             self._drawing = True
             return
 
         elif event == cv2.EVENT_LBUTTONUP:
             # Connect the last point with the first one
-            if len(self._trajectory) > 1:
-                self._trajectory.append(self._trajectory[0])
+            if self._trajectory_length > 1:
+                self._trajectory[self._trajectory_length] = self._trajectory[0]
+                self._trajectory_length += 1
 
-            trajectory = self.tracker.process_trajectory(self._trajectory)
+            trajectory = self.tracker.process_trajectory(
+                self._trajectory[: self._trajectory_length]
+            )
             # Send the trajectory
             if self.comm.send_trajectory(trajectory):
                 self._trajectory_state = App.TrajectoryStates.STATE_TRANSMISSION_PASS
@@ -161,33 +245,53 @@ class App:
             return
 
         elif event == cv2.EVENT_RBUTTONUP and not self._drawing:
-            self._trajectory.clear()
+            self._trajectory_length = 0
             self._trajectory_state = App.TrajectoryStates.STATE_DRAWING
             return
 
+    @staticmethod
+    def _pin_thread(cpu):
+        """
+        Pins the calling thread to a single CPU, to keep its caches hot
+
+        :param cpu:     Index of the CPU
+        """
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, {cpu})
+            elif sys.platform == "win32":
+                kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+                # Declare the types, so masks of CPUs above 31 aren't truncated
+                kernel32.GetCurrentThread.restype = wintypes.HANDLE
+                set_affinity = kernel32.SetThreadAffinityMask
+                set_affinity.argtypes = (wintypes.HANDLE, ctypes.c_size_t)
+                set_affinity.restype = ctypes.c_size_t
+                # Zero previous affinity mask signals a failure
+                if not set_affinity(kernel32.GetCurrentThread(), 1 << cpu):
+                    raise ctypes.WinError(ctypes.get_last_error())
+        except OSError:
+            print("Failed to pin the application to CPU %d!" % cpu)
+
     def run(self):
         """ Run the app state machine """
-        with mss() as capture:
-            while True:
-                if self._state == App.States.STATE_HANDSHAKE:
-                    self._state_handshake()
-                    continue
-
-                elif self._state == App.States.STATE_CAPTURE_AREA:
-                    self._state_capture_area(capture)
-                    continue
+        # State handlers, looked up once per iteration
+        handlers = {
+            App.States.STATE_HANDSHAKE: lambda capture: self._state_handshake(),
+            App.States.STATE_CAPTURE_AREA: self._state_capture_area,
+            App.States.STATE_CALIBRATE: self._state_calibrate,
+            App.States.STATE_TRACKING: self._state_tracking,
+        }
 
-                elif self._state == App.States.STATE_CALIBRATE:
-                    self._state_calibrate(capture)
-                    continue
+        with create_grabber() as capture:
+            # Pin the tracking loop after the capture thread was started, so the
+            # capture doesn't share the CPU
+            if self._cpu is not None:
+                App._pin_thread(self._cpu)
 
-                elif self._state == App.States.STATE_TRACKING:
-                    self._state_tracking(capture)
-                    continue
+            while self._state != App.States.STATE_QUIT:
+                handlers[self._state](capture)
 
-                elif self._state == App.States.STATE_QUIT:
-                    self._state_quit()
-                    break
+            self._state_quit()
 
     def _state_handshake(self):
         """
@@ -226,39 +330,45 @@ class App:
         """
         if self._screen_capture is None:
             # Grab the screen shot, when first time entering the state
-            self._screen_capture = np.asarray(capture.grab(capture.monitors[1]))
+            self._screen_capture = capture.grab(capture.monitor)
             # OpenCV window initialization
             cv2.namedWindow(self._name, cv2.WND_PROP_FULLSCREEN)
             cv2.setWindowProperty(
                 self._name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN
             )
-            cv2.setMouseCallback(self._name, self._mouse_callback)
+            cv2.setMouseCallback(self._name, self._mouse_callback_select)
+            # Draw instruction once, directly on the screen shot
+            App._draw_instruction(self._screen_capture, "Select the capture area")
 
-        # Copy the screen shot, to prevent over-drawing
-        screen = self._screen_capture.copy()
-        # Draw the area selection rectangle
+        screen = self._screen_capture
         if self._selecting_capture:
+            # Save only the pixels under the area selection rectangle
+            (x1, y1), (x2, y2) = np.sort(self._capture_area, axis=0).tolist()
+            roi = (slice(max(y1, 0), y2 + 1), slice(max(x1, 0), x2 + 1))
+            saved = screen[roi].copy()
+            # Draw the area selection rectangle
             p1, p2 = tuple(self._capture_area[0, :]), tuple(self._capture_area[1, :])
             cv2.rectangle(screen, p1, p2, App.COLOR_DRAW, thickness=1)
+            # Draw image and restore the screen shot, to prevent over-drawing
+            cv2.imshow(self._name, screen)
+            screen[roi] = saved
+        else:
+            # Draw image
+            cv2.imshow(self._name, screen)
 
-        # Draw instruction
-        App._draw_instruction(screen, "Select the capture area")
-        # Draw image
-        cv2.imshow(self._name, screen)
-
-        if cv2.waitKey(1) & 0xFF == ord(App.KEY_QUIT):
+        if cv2.waitKey(1) & 0xFF == App.KEY_QUIT_CODE:
             self._state = App.States.STATE_QUIT
 
     def _state_calibrate(self, capture):
-        screen = np.asarray(capture.grab(self._capture_coord))
+        screen = capture.grab(self._capture_coord)
 
         coordinates = self.tracker.calibrate(screen)
         if coordinates is not None:
-            for i in coordinates:
-                # Convert pixel coordinates as floats to integers
-                i = np.uint16(np.around(i))
-                x, y, r = i
+            # Convert all pixel coordinates as floats to integers at once
+            marks = np.rint(coordinates).astype(np.uint16)
+            for x, y, r in marks.tolist():
                 cv2.circle(screen, (x, y), r, App.COLOR_MARK, thickness=1)
+            self._prepare_tracking()
             self._state = App.States.STATE_TRACKING
             self._calibration_retries = 0
             return
@@ -276,32 +386,55 @@ class App:
             else:
                 self._calibration_retries += 1
 
-    def _state_tracking(self, capture):
+    def _prepare_tracking(self):
+        """ Prepare the buffers and the window for the selected capture area size """
+        width, height = self._capture_coord["width"], self._capture_coord["height"]
+        # Grayscale buffer and the rendered instructions
+        self._gray = np.empty((height, width), dtype=np.uint8)
+        self._instructions = App._render_instructions(
+            (height, width), App.TRACKING_INSTRUCTIONS
+        )
+        # Resize the window to the capture area
+        cv2.resizeWindow(self._name, width, height)
+        cv2.setWindowProperty(self._name, cv2.WND_PROP_AUTOSIZE, cv2.WINDOW_NORMAL)
+        # Switch the mouse handling to trajectory drawing
+        cv2.setMouseCallback(self._name, self._mouse_callback_trajectory)
+
+    def _process_frame(self, screen):
         """
-        Track the ball and send the coordinates
+        Locate the ball, send its coordinates and draw the overlays
 
-        :param capture:     Reference to the screen capture instance
+        :param screen:      Captured BGRA frame, drawn on in place
         """
-        # Capture the selected area
-        screen = np.asarray(capture.grab(self._capture_coord))
-        image = cv2.cvtColor(screen, cv2.COLOR_BGRA2GRAY)
+        if self._cuda:
+            # Convert the frame on the GPU and keep it there for the tracker
+            self._gpu_screen.upload(screen)
+            cv2.cuda.cvtColor(
+                self._gpu_screen, cv2.COLOR_BGRA2GRAY, dst=self._gpu_gray
+            )
+            image = self._gpu_gray
+        elif self._opencl:
+            # Convert the frame on the OpenCL device and keep it there for the tracker
+            image = cv2.cvtColor(cv2.UMat(screen), cv2.COLOR_BGRA2GRAY)
+        else:
+            # Convert into the buffer, prepared for the capture area size
+            image = cv2.cvtColor(screen, cv2.COLOR_BGRA2GRAY, dst=self._gray)
 
         # Locate the ball
-        coordinates = self.tracker.find(image)
+        result = self.tracker.find(image, size=(screen.shape[1], screen.shape[0]))
 
-        if coordinates is not None:
+        self._last_positions = None
+        if result is not None:
             # Send ball coordinates to the robot controller
-            for c in coordinates[:, 3:]:
-                self.comm.send_ball_position(c)
-
-            # Mark detected ball
-            for i in coordinates[:, :3]:
-                # Convert pixel coordinates as floats to integers
-                i = np.uint16(np.around(i))
-                x, y, r = i
+            self._last_positions = result.mm
+            self.comm.send_ball_positions(self._last_positions)
+
+            # Mark detected ball - convert all pixel coordinates to integers at once
+            marks = np.rint(result.pixels).astype(np.uint16)
+            for x, y, r in marks.tolist():
                 cv2.circle(screen, (x, y), r, App.COLOR_MARK, thickness=1)
 
-        if len(self._trajectory) > 1:
+        if self._trajectory_length > 1:
             # Select trajectory color
             if self._trajectory_state == App.TrajectoryStates.STATE_TRANSMISSION_PASS:
                 color = App.COLOR_PASS
@@ -311,40 +444,58 @@ class App:
                 color = App.COLOR_DRAW
 
             # Draw trajectory
-            trajectory = [i[:2] for i in self._trajectory]
-            pts = np.asarray(trajectory, np.int32)
+            pts = self._trajectory[: self._trajectory_length]
             cv2.polylines(screen, [pts], False, color, thickness=1)
 
         # Draw instruction
-        App._draw_instruction(
-            screen, "Press the left button to start drawing the trajectory"
-        )
-        App._draw_instruction(
-            screen, "Press the right button to clear the trajectory", position=(50, 75)
-        )
-        App._draw_instruction(
-            screen, "Press R key to reselect the capture area", position=(50, 100)
-        )
-        App._draw_instruction(
-            screen, "Press Q key to quit the program", position=(50, 125)
+        App._blend_instructions(screen, *self._instructions)
+
+    def _state_tracking(self, capture):
+        """
+        Track the ball and send the coordinates
+
+        :param capture:     Reference to the screen capture instance
+        """
+        # Capture the selected area
+        screen = capture.grab(self._capture_coord)
+
+        # Skip the tracking and drawing of unchanged frames
+        frame_key = (
+            zlib.crc32(screen),
+            self._trajectory_length,
+            self._trajectory_state,
         )
+        if (
+            frame_key == self._last_frame_key
+            and self._skipped_frames < App.FRAME_REFRESH_INTERVAL
+        ):
+            self._skipped_frames += 1
+            screen = self._last_rendered
+            if self._last_positions is not None:
+                # Keep the controller fed with the last known positions
+                self.comm.send_ball_positions(self._last_positions)
+        else:
+            self._skipped_frames = 0
+            self._last_frame_key = frame_key
+            self._process_frame(screen)
+            self._last_rendered = screen
 
         # Draw image
-        cv2.resizeWindow(
-            self._name, self._capture_coord["width"], self._capture_coord["height"]
-        )
-        cv2.setWindowProperty(self._name, cv2.WND_PROP_AUTOSIZE, cv2.WINDOW_NORMAL)
         cv2.imshow(self._name, screen)
-        # OpenCV mainloop
-        key = cv2.waitKey(1) & 0xFF
+        # OpenCV mainloop - poll the events without the 1 ms wait on most frames
+        self._frame_counter += 1
+        if self._frame_counter % App.KEY_WAIT_INTERVAL and self._poll_key:
+            key = cv2.pollKey() & 0xFF
+        else:
+            key = cv2.waitKey(1) & 0xFF
 
         # Reselect capture area
-        if key == ord(App.KEY_CAPTURE_AREA):
+        if key == App.KEY_CAPTURE_AREA_CODE:
             self._state = App.States.STATE_CAPTURE_AREA
             return
 
         # Quit
-        elif key == ord(App.KEY_QUIT):
+        elif key == App.KEY_QUIT_CODE:
             self._state = App.States.STATE_QUIT
 
     def _state_quit(self):
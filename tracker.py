@@ -4,30 +4,63 @@ Tracker module
 Module provides object position tracking capability from an image/video.
 """
 from abc import abstractmethod
+from collections import namedtuple
 
 import numpy as np
 import cv2
 
 
+# Located object coordinates - pixels (x, y, r) and millimeters (x, y, z) as Nx3 arrays
+TrackResult = namedtuple("TrackResult", ("pixels", "mm"))
+
+
+def cuda_enabled():
+    """
+    Check if OpenCV was built with CUDA support and a CUDA device is present
+
+    :return:    Can OpenCV CUDA functions be used
+    """
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
 class ObjectTracker:
     """ Abstract object tracker base class """
 
     CALIBRATION_RETRIES = 10
 
     def __init__(self):
-        self._pixel_ratio = 0.69
-        self._x_offset = 0
-        self._y_offset = 0
         self._calibrated = False
+        self._set_calibration(0, 0, 0.69)
+
+    def _set_calibration(self, x_offset, y_offset, pixel_ratio):
+        """
+        Set the pixel to mm conversion parameters
+
+        :param x_offset:        X coordinate of the origin in pixels
+        :param y_offset:        Y coordinate of the origin in pixels
+        :param pixel_ratio:     Pixel to mm ratio
+        """
+        self._x_offset = x_offset
+        self._y_offset = y_offset
+        self._pixel_ratio = pixel_ratio
+        # X and Y conversion parameters as arrays, to convert both axes at once - in
+        # single precision, to keep the conversion of the circles in float32
+        self._xy_offset = np.array((x_offset, y_offset), dtype=np.float32)
+        self._xy_ratio = np.array((pixel_ratio, -pixel_ratio), dtype=np.float32)
 
     @abstractmethod
-    def find(self, image):
+    def find(self, image, size=None):
         """
         Locate the object on the image and return its position
 
-        :param image:   Grayscale image as 2D Numpy array
+        :param image:   Grayscale image as 2D Numpy array, cv2.UMat or cv2.cuda_GpuMat
+        :param size:    Image size as (width, height) - needed for the cv2.UMat images,
+                        as their size isn't known on the host
 
-        :return:        Object coordinates as 2D Numpy array
+        :return:        Object coordinates as TrackResult or None
         """
         pass
 
@@ -36,88 +69,241 @@ class ObjectTracker:
         """
         Calculate pixel to mm ratio
 
-        :param image:   BGR image as 3D Numpy array
+        :param image:   BGR or BGRA image as 3D Numpy array
 
         :return:        Coordinates of calibration markers
         """
         pass
 
-    def _pixels_to_mm(self, pixel_coordinates):
+    def _pixels_to_mm(self, pixel_coordinates, out=None):
         """
         Converts coordinates in pixels, to coordinates in millimeters
 
         :param pixel_coordinates:     Coordinates in pixels as Numpy array
+        :param out:             Array of the same shape to store the result in, with
+                                the Z coordinates already set to 0
 
         :return:                Coordinates in millimeters as Numpy array
         """
-        mm_coordinates = pixel_coordinates.copy()  # * self._pixel_ratio
-        mm_coordinates[:, 0] -= self._x_offset
-        mm_coordinates[:, 1] -= self._y_offset
-        mm_coordinates[:, 2] = 0
-        mm_coordinates[:, 0] *= self._pixel_ratio
-        mm_coordinates[:, 1] *= -self._pixel_ratio
+        if out is None:
+            out = np.zeros_like(pixel_coordinates)
+        # Write the shifted and scaled X and Y directly into the result
+        xy = out[:, :2]
+        np.subtract(pixel_coordinates[:, :2], self._xy_offset, out=xy)
+        np.multiply(xy, self._xy_ratio, out=xy)
 
-        return mm_coordinates
+        return out
 
     def process_trajectory(self, trajectory):
         """
         Converts trajectory pixel coordinates to millimeters
 
-        :param trajectory:  List of coordinates as tuples of size 3
+        :param trajectory:  2D numpy array of size Nx2 with pixel coordinates
 
         :return:            2D numpy array of size Nx3
         """
-        trajectory_mm = np.asarray(trajectory, dtype=np.double)
-        return self._pixels_to_mm(trajectory_mm)
+        trajectory_mm = np.zeros((trajectory.shape[0], 3), dtype=np.double)
+        trajectory_mm[:, :2] = trajectory
+        return self._pixels_to_mm(trajectory_mm, out=trajectory_mm)
 
 
 class BallTracker(ObjectTracker):
+
+    # Downscale factor of the image, before searching for the circles
+    DETECT_SCALE = 2
+    # Circle search parameters, in pixels of the downscaled image
+    MIN_DISTANCE = 25 / DETECT_SCALE
+    MIN_RADIUS = 15 // DETECT_SCALE
+    MAX_RADIUS = 30 // DETECT_SCALE
+    VOTES_THRESHOLD = 25 // DETECT_SCALE
+    # Canny threshold and the min. circle perfectness of the CPU circle search
+    ALT_CANNY_THRESHOLD = 300
+    ALT_PERFECTNESS = 0.85
+    # Half size of the search window around the last ball position [pixels]
+    SEARCH_WINDOW = 4 * 30
+
     def __init__(self):
         super().__init__()
-        self.previous_coord = np.array((0, 0, 0))
+        self.previous_coord = np.zeros((1, 3), dtype=np.float32)
         self.treshold = np.array((0.001, 0.001, 0))
+        # Reused downscaled image and millimeter coordinates buffers
+        self._small = None
+        self._mm = np.zeros((1, 3), dtype=np.float32)
+        # Constant velocity model of the ball, to search for it around its predicted
+        # position first [pixels, pixels/frame]
+        self._tracking = False
+        self._kalman = cv2.KalmanFilter(4, 2)
+        self._kalman.transitionMatrix = np.array(
+            ((1, 0, 1, 0), (0, 1, 0, 1), (0, 0, 1, 0), (0, 0, 0, 1)), dtype=np.float32
+        )
+        self._kalman.measurementMatrix = np.eye(2, 4, dtype=np.float32)
+        self._kalman.processNoiseCov = np.eye(4, dtype=np.float32)
+        self._kalman.measurementNoiseCov = np.eye(2, dtype=np.float32)
+        # Circle detector on the GPU, used if a CUDA device is present
+        self._hough = None
+        self._gpu_small = None
+        if cuda_enabled():
+            self._hough = cv2.cuda.createHoughCirclesDetector(
+                dp=1,
+                minDist=BallTracker.MIN_DISTANCE,
+                cannyThreshold=50,
+                votesThreshold=BallTracker.VOTES_THRESHOLD,
+                minRadius=BallTracker.MIN_RADIUS,
+                maxRadius=BallTracker.MAX_RADIUS,
+            )
+            self._gpu_small = cv2.cuda_GpuMat()
 
-    def find(self, image):
-        if not self._calibrated:
-            return None
+    def _crop(self, image, center, size):
+        """
+        Crop the image around the expected position of the ball
 
-        # Find circles
-        pixel_coordinates = cv2.HoughCircles(
+        :param image:   Grayscale image as 2D Numpy array, cv2.UMat or cv2.cuda_GpuMat
+        :param center:  Expected position of the ball as (x, y) in pixels
+        :param size:    Image size as (width, height)
+
+        :return:        Cropped image and the offset of its top left corner
+        """
+        width, height = size
+        # Keep the window on the image, even if the ball is expected outside of it
+        x = min(max(center[0], 0), width - 1)
+        y = min(max(center[1], 0), height - 1)
+        # Align the window to the downscaling grid, to keep the positions consistent
+        x0 = max(int(x) - BallTracker.SEARCH_WINDOW, 0)
+        y0 = max(int(y) - BallTracker.SEARCH_WINDOW, 0)
+        x0 -= x0 % BallTracker.DETECT_SCALE
+        y0 -= y0 % BallTracker.DETECT_SCALE
+        x1 = min(int(x) + BallTracker.SEARCH_WINDOW, width)
+        y1 = min(int(y) + BallTracker.SEARCH_WINDOW, height)
+
+        if isinstance(image, np.ndarray):
+            return image[y0:y1, x0:x1], (x0, y0)
+        if isinstance(image, cv2.UMat):
+            return cv2.UMat(image, (y0, y1), (x0, x1)), (x0, y0)
+        return image.rowRange(y0, y1).colRange(x0, x1), (x0, y0)
+
+    def _downscale(self, image):
+        """
+        Downscale the image by the detection scale factor
+
+        :param image:   Grayscale image as 2D Numpy array, cv2.UMat or cv2.cuda_GpuMat
+
+        :return:        Downscaled image of the same type
+        """
+        scale = BallTracker.DETECT_SCALE
+        if isinstance(image, cv2.UMat):
+            return cv2.resize(
+                image, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA
+            )
+
+        if isinstance(image, np.ndarray):
+            shape = (image.shape[0] // scale, image.shape[1] // scale)
+            # Reuse the buffer, while the image size doesn't change
+            if self._small is None or self._small.shape != shape:
+                self._small = np.empty(shape, dtype=np.uint8)
+            return cv2.resize(
+                image, shape[::-1], dst=self._small, interpolation=cv2.INTER_AREA
+            )
+
+        width, height = image.size()
+        return cv2.cuda.resize(
             image,
-            cv2.HOUGH_GRADIENT,
-            1,
-            25,
-            param1=50,
-            param2=25,
-            minRadius=15,
-            maxRadius=30,
+            (width // scale, height // scale),
+            dst=self._gpu_small,
+            interpolation=cv2.INTER_AREA,
         )
 
+    def _find_circles(self, image):
+        """
+        Find circles on the downscaled image, on the GPU if possible
+
+        :param image:   Grayscale image as 2D Numpy array, cv2.UMat or cv2.cuda_GpuMat
+
+        :return:        Circles in full scale pixels as 3D Numpy array of size 1xNx3
+                        or None
+        """
+        if not isinstance(image, (np.ndarray, cv2.UMat)) and self._hough is None:
+            image = image.download()
+        image = self._downscale(image)
+
+        if not isinstance(image, (np.ndarray, cv2.UMat)):
+            circles = self._hough.detect(image)
+            circles = None if circles.empty() else circles.download()
+        else:
+            circles = cv2.HoughCircles(
+                image,
+                cv2.HOUGH_GRADIENT_ALT,
+                1,
+                BallTracker.MIN_DISTANCE,
+                param1=BallTracker.ALT_CANNY_THRESHOLD,
+                param2=BallTracker.ALT_PERFECTNESS,
+                minRadius=BallTracker.MIN_RADIUS,
+                maxRadius=BallTracker.MAX_RADIUS,
+            )
+            # OpenCL images return the circles as cv2.UMat
+            if isinstance(circles, cv2.UMat):
+                circles = circles.get()
+
+        if circles is None:
+            return None
+        # Circle coordinates are relative to the pixel corners, so they scale directly
+        circles *= BallTracker.DETECT_SCALE
+        return circles
+
+    def find(self, image, size=None):
+        if not self._calibrated:
+            return None
+
+        if size is None and isinstance(image, np.ndarray):
+            size = image.shape[::-1]
+        elif size is None and not isinstance(image, cv2.UMat):
+            size = image.size()
+        # Find circles - around the predicted ball position first, on the whole image
+        # if it wasn't found there (or the size of an OpenCL image isn't known)
+        pixel_coordinates = None
+        if self._tracking:
+            center = self._kalman.predict()[:2, 0].tolist()
+        if self._tracking and size is not None:
+            window, offset = self._crop(image, center, size)
+            pixel_coordinates = self._find_circles(window)
+            if pixel_coordinates is not None:
+                pixel_coordinates[..., :2] += offset
+        if pixel_coordinates is None:
+            pixel_coordinates = self._find_circles(image)
+
         # Validate coordinates
         if pixel_coordinates is None:
+            self._tracking = False
             return None
-        pixel_coordinates = pixel_coordinates.reshape(pixel_coordinates.shape[1:])
-        # Store all coordinates in a single array
-        mm_coordinates = self._pixels_to_mm(pixel_coordinates)
-        coordinates = np.empty(
-            (pixel_coordinates.shape[0], pixel_coordinates.shape[1] * 2)
-        )
-        if np.all(abs(mm_coordinates - self.previous_coord) >= self.treshold):
-            coordinates[:, 3:] = mm_coordinates
-            self.previous_coord = mm_coordinates
+        # Keep only the strongest circle - a single ball is tracked
+        pixel_coordinates = pixel_coordinates[0, :1]
+        if self._tracking:
+            self._kalman.correct(pixel_coordinates[0, :2].reshape(2, 1))
+        else:
+            self._kalman.statePost = np.array(
+                (*pixel_coordinates[0, :2], 0, 0), dtype=np.float32
+            ).reshape(4, 1)
+            self._kalman.errorCovPost = np.eye(4, dtype=np.float32)
+            self._tracking = True
+        mm_coordinates = self._pixels_to_mm(pixel_coordinates, out=self._mm)
+        # Compare the scalars, without the Numpy temporaries
+        x, y, _ = mm_coordinates[0].tolist()
+        previous_x, previous_y, _ = self.previous_coord[0].tolist()
+        if (
+            abs(x - previous_x) >= self.treshold[0]
+            and abs(y - previous_y) >= self.treshold[1]
+        ):
+            np.copyto(self.previous_coord, mm_coordinates)
         else:
-            coordinates[:, 3:] = self.previous_coord
-        coordinates[:, :3] = pixel_coordinates
+            np.copyto(mm_coordinates, self.previous_coord)
 
-        return coordinates
+        return TrackResult(pixel_coordinates, mm_coordinates)
 
     def calibrate(self, image):
 
-        imGray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
-        imgH = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        hue = imgH[:, :, 0]
-        x_calib, y_calib, center = [1, 1, 1], [1, 1, 1], [1, 1, 1]
-        found_x, found_y, found_center = False, False, False
+        if image.shape[2] == 4:
+            imGray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+        else:
+            imGray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
         coord = cv2.HoughCircles(
             imGray,
@@ -132,24 +318,26 @@ class BallTracker(ObjectTracker):
         if coord is None:
             return None
         coord = np.uint16(np.around(coord[0, :]))
-        for (x, y, r) in coord:
-            if hue[y, x] >= 80:  # blue ball
-                x_calib = [x, y, r]
-                found_x = True
-            elif hue[y, x] <= 20:  # red bal
-                center = [x, y, r]
-                found_center = True
-            else:  # green ball
-                y_calib = [x, y, r]
-                found_y = True
-
-        if not (found_x and found_y and found_center):
+        # Classify all balls by the hue at their centers at once - only the center
+        # pixels are converted to HSV
+        centers = np.ascontiguousarray(image[coord[:, 1], coord[:, 0], np.newaxis, :3])
+        hues = cv2.cvtColor(centers, cv2.COLOR_BGR2HSV)[:, 0, 0]
+        blue = hues >= 80
+        red = hues <= 20
+        green = ~(blue | red)
+        if not (blue.any() and red.any() and green.any()):
             return None
+        # The circles are ordered by their strength - use the strongest of each color
+        x_calib = coord[np.argmax(blue)].tolist()
+        center = coord[np.argmax(red)].tolist()
+        y_calib = coord[np.argmax(green)].tolist()
 
-        self._x_offset, self._y_offset = center[0], center[1]
-        self._pixel_ratio = 0.1 / (
-            (center[1] - y_calib[1] + x_calib[0] - center[0]) / 2
-        )
+        # The X marker is right and the Y marker above the center - anything else
+        # is a misclassification
+        distance = (center[1] - y_calib[1] + x_calib[0] - center[0]) / 2
+        if distance <= 0:
+            return None
+        self._set_calibration(center[0], center[1], 0.1 / distance)
 
         coordinates = np.array((x_calib, y_calib))
         self._calibrated = True